@@ -1,17 +1,27 @@
 # app.py   →   streamlit run app.py
 
 import streamlit as st
-import json
-import base64
-from datetime import datetime
+import html
+import random
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import islice
+from datetime import datetime, timezone
 from pathlib import Path
-from typing import TypedDict, List, Dict, Literal, Annotated
+from typing import TypedDict, List, Dict, Literal, Annotated, Tuple, Any, Callable, Iterator, DefaultDict
+
+import orjson
 
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
+from googleapiclient.http import build_http, set_user_agent
 
 from config import CONFIG
 
@@ -43,7 +53,6 @@ class Email(TypedDict):
     subject: str
     sender: str
     date: str
-    body_b64: str
     preview: str
 
 class SenderGroup(TypedDict):
@@ -66,8 +75,14 @@ class AgentState(TypedDict):
 # Gmail Service (cached)
 # ──────────────────────────────────────────────────────────────
 
-@st.cache_resource
-def get_gmail_service():
+def _token_mtime_ns() -> int:
+    token_path = CONFIG.token_file
+    return token_path.stat().st_mtime_ns if token_path.exists() else 0
+
+# token_mtime_ns is only part of the cache key: an unchanged token.json is parsed
+# once per process, a rewritten one (new login or refresh) is loaded again
+@st.cache_resource(max_entries=1)
+def get_gmail_credentials(token_mtime_ns: int) -> Credentials:
     creds = None
     token_path = CONFIG.token_file
     if token_path.exists():
@@ -84,19 +99,152 @@ def get_gmail_service():
                 str(CONFIG.credentials_file), CONFIG.scopes
             )
             creds = flow.run_local_server(port=0)
-            with token_path.open("w") as f:
-                f.write(creds.to_json())
-
-    return build("gmail", "v1", credentials=creds)
-
-SERVICE = get_gmail_service()
+        with token_path.open("w") as f:
+            f.write(creds.to_json())
+
+    return creds
+
+# Google only gzips responses when the User-Agent mentions gzip; googleapiclient
+# does this for single calls but not for the multipart batch envelope
+USER_AGENT = "gmail-agent (gzip)"
+
+def _authorized_http(creds: Credentials) -> AuthorizedHttp:
+    # build_http() is what build(credentials=...) uses: it sets the socket timeout
+    # and redirect handling. The User-Agent goes on this inner transport because
+    # AuthorizedHttp.request re-enters itself with extra kwargs on a 401 retry.
+    return AuthorizedHttp(creds, http=set_user_agent(build_http(), USER_AGENT))
+
+@st.cache_resource(max_entries=1)
+def get_gmail_service(token_mtime_ns: int):
+    # The Gmail discovery document ships with googleapiclient — no HTTP fetch needed
+    return build(
+        "gmail", "v1",
+        http=_authorized_http(get_gmail_credentials(token_mtime_ns)),
+        static_discovery=True,
+        cache_discovery=False,
+    )
+
+TOKEN_MTIME_NS = _token_mtime_ns()
+CREDS = get_gmail_credentials(TOKEN_MTIME_NS)
+SERVICE = get_gmail_service(TOKEN_MTIME_NS)
+
+# httplib2 connections are not thread-safe, so every worker thread gets its own
+_thread_local = threading.local()
+
+def _thread_http() -> AuthorizedHttp:
+    if not hasattr(_thread_local, "http"):
+        _thread_local.http = _authorized_http(CREDS)
+    return _thread_local.http
 
 # ──────────────────────────────────────────────────────────────
 # Core functions (slightly adapted)
 # ──────────────────────────────────────────────────────────────
 
+TRASH_BATCH_SIZE = 1000  # messages.batchModify accepts at most 1000 ids
+SAVE_WORKERS = 16        # concurrent archive file writes
+MAX_RETRIES = 5
+RETRY_STATUSES = {429, 503}
+METADATA_HEADERS = ["Subject", "From", "Date"]
+WANTED_HEADERS = frozenset(h.lower() for h in METADATA_HEADERS)
+SENDER_RE = re.compile(r"<([^>]+)>")   # address part of "Name <addr@host>"
+_SAFE_TBL = str.maketrans({"@": "_", ".": "_", "/": "_", "\\": "_"})   # sender → filename-safe
+
+def _is_retryable(error: Exception) -> bool:
+    return isinstance(error, HttpError) and error.resp.status in RETRY_STATUSES
+
+def _parse_metadata(mid: str, msg: dict) -> Email:
+    headers: Dict[str, str] = {}
+    for h in msg["payload"]["headers"]:
+        name = h["name"].lower()
+        if name in WANTED_HEADERS and name not in headers:
+            headers[name] = h["value"]
+            if len(headers) == len(WANTED_HEADERS):
+                break
+
+    snippet = html.unescape(msg.get("snippet", ""))   # Gmail entity-escapes snippets
+
+    return {
+        "id": mid,
+        "subject": headers.get("subject", "(no subject)"),
+        "sender": headers.get("from", "Unknown"),
+        "date": headers.get("date", "Unknown"),
+        "preview": snippet[:140] + "…" if len(snippet) > 140 else snippet,
+    }
+
+def _parse_raw(mid: str, msg: dict) -> str:
+    return msg["raw"]
+
+def _fetch_chunk(ids: List[str], parse: Callable, **params) -> Tuple[Dict[str, Any], Dict[str, Exception]]:
+    """Fetch one batch of messages, retrying rate-limited calls with exponential backoff.
+
+    Runs on a worker thread, so it must not touch Streamlit — failures are
+    returned to the caller instead of being reported here.
+    """
+    fetched: Dict[str, Any] = {}
+    failed: Dict[str, Exception] = {}
+    pending = ids
+
+    for attempt in range(MAX_RETRIES + 1):
+        retry: Dict[str, Exception] = {}
+
+        def on_message(request_id, msg, exception):
+            if exception is None:
+                fetched[request_id] = parse(request_id, msg)
+            elif _is_retryable(exception):
+                retry[request_id] = exception
+            else:
+                failed[request_id] = exception
+
+        batch = SERVICE.new_batch_http_request(callback=on_message)
+        for mid in pending:
+            batch.add(
+                SERVICE.users().messages().get(userId="me", id=mid, **params),
+                request_id=mid,
+            )
+
+        try:
+            batch.execute(http=_thread_http())
+        except HttpError as e:
+            if not _is_retryable(e):
+                failed.update(dict.fromkeys(pending, e))
+                break
+            retry = dict.fromkeys(pending, e)
+
+        if not retry:
+            break
+        if attempt == MAX_RETRIES:
+            failed.update(retry)
+            break
+
+        time.sleep(2 ** attempt + random.random())
+        pending = list(retry)
+
+    return fetched, failed
+
+def _fetch_all(
+    ids: List[str], parse: Callable, batch_size: int, workers: int, **params
+) -> Iterator[Tuple[Dict[str, Any], Dict[str, Exception]]]:
+    """Fetch ids in batches on the worker pool, yielding each batch's results as it completes.
+
+    Only `workers` batches are queued at a time, and a new one is queued only after a
+    finished batch has been handed to the caller. So at most workers + 1 batches are
+    held at once: the ones downloading and the one the caller is still processing.
+    """
+    chunks = (ids[start:start + batch_size] for start in range(0, len(ids), batch_size))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {pool.submit(_fetch_chunk, chunk, parse, **params) for chunk in islice(chunks, workers)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            while done:
+                result = done.pop().result()
+                yield result
+                del result  # release this batch before queueing the next one
+
+                chunk = next(chunks, None)
+                if chunk is not None:
+                    pending.add(pool.submit(_fetch_chunk, chunk, parse, **params))
+
 def fetch_emails(state: AgentState) -> AgentState:
-    st.session_state.state = state
     st.info(f"Fetching up to {state['max_fetch']} messages...")
 
     try:
@@ -107,121 +255,151 @@ def fetch_emails(state: AgentState) -> AgentState:
         ).execute()
 
         ids = [m["id"] for m in res.get("messages", [])]
+        fetched: Dict[str, Email] = {}
         emails: List[Email] = []
 
         progress = st.progress(0)
         status_text = st.empty()
-
-        for i, mid in enumerate(ids, 1):
-            status_text.text(f"Fetching email {i}/{len(ids)}")
-            progress.progress(i / len(ids))
-
-            msg = SERVICE.users().messages().get(
-                userId="me", id=mid, format="full"
-            ).execute()
-
-            headers = {h["name"].lower(): h["value"] for h in msg["payload"]["headers"]}
-
-            body_b64 = ""
-            payload = msg["payload"]
-            if "parts" in payload:
-                for part in payload["parts"]:
-                    if part.get("mimeType") == "text/plain" and "data" in part.get("body", {}):
-                        body_b64 = part["body"]["data"]
-                        break
-            elif "body" in payload and "data" in payload["body"]:
-                body_b64 = payload["body"]["data"]
-
-            preview = ""
-            if body_b64:
-                try:
-                    decoded = base64.urlsafe_b64decode(body_b64).decode("utf-8", errors="replace")
-                    preview = decoded[:140] + "…" if len(decoded) > 140 else decoded
-                except:
-                    preview = "[decode error]"
-
-            emails.append({
-                "id": mid,
-                "subject": headers.get("subject", "(no subject)"),
-                "sender": headers.get("from", "Unknown"),
-                "date": headers.get("date", "Unknown"),
-                "body_b64": body_b64,
-                "preview": preview,
-            })
+        live = st.empty()
+        done = 0
+
+        # One HTTP round-trip per batch, several batches in flight at once
+        for chunk_emails, chunk_failed in _fetch_all(
+            ids,
+            _parse_metadata,
+            CONFIG.fetch_batch_size,
+            CONFIG.fetch_workers,
+            format="metadata",
+            metadataHeaders=METADATA_HEADERS,
+        ):
+            fetched.update(chunk_emails)
+            for mid, err in chunk_failed.items():
+                st.error(f"Failed to fetch {mid}: {err}")
+
+            done += len(chunk_emails) + len(chunk_failed)
+            status_text.text(f"Fetching email {done}/{len(ids)}")
+            progress.progress(done / len(ids))
+
+            # Keep the inbox order regardless of which chunk finished first
+            emails = [fetched[mid] for mid in ids if mid in fetched]
+
+            # Show the senders seen so far while the remaining batches download
+            with live.container():
+                render_sender_tally(emails)
 
         status_text.success(f"Fetched {len(emails)} emails")
         progress.empty()
 
-        return {**state, "emails": emails}
+        return {"emails": emails}
 
     except HttpError as e:
         st.error(f"Fetch error: {e}")
-        return state
+        return {"emails": []}
+
+def _normalize_sender(sender_raw: str) -> str:
+    m = SENDER_RE.search(sender_raw)
+    return (m.group(1) if m else sender_raw).strip().lower()
+
+def render_sender_tally(emails: List[Email], limit: int = 10) -> None:
+    """Top senders among the emails fetched so far."""
+    counts = Counter(_normalize_sender(e["sender"]) for e in emails)
+    st.markdown(f"**Top senders so far** ({len(counts)} total):")
+    for sender, count in counts.most_common(limit):
+        st.write(f"**{count}** • {sender}")
 
 def group_by_sender(state: AgentState) -> AgentState:
-    groups: Dict[str, SenderGroup] = {}
+    by_sender: DefaultDict[str, List[Email]] = defaultdict(list)
 
     for email in state.get("emails", []):
-        sender_raw = email["sender"].strip()
-        sender = (
-            sender_raw.split("<")[1].split(">")[0].strip().lower()
-            if "<" in sender_raw and ">" in sender_raw else sender_raw.lower()
-        )
+        by_sender[_normalize_sender(email["sender"])].append(email)
 
-        if sender not in groups:
-            groups[sender] = {"sender": sender, "emails": [], "count": 0}
-        groups[sender]["emails"].append(email)
-        groups[sender]["count"] += 1
+    groups: Dict[str, SenderGroup] = {
+        sender: {"sender": sender, "emails": emails, "count": len(emails)}
+        for sender, emails in by_sender.items()
+    }
 
     st.success(f"Grouped into {len(groups)} senders")
-    return {**state, "groups": groups}
+    return {"groups": groups}
+
+def _write_archive(path: Path, payload: dict) -> Path:
+    # orjson emits UTF-8 bytes directly, like json.dump(..., ensure_ascii=False)
+    path.write_bytes(orjson.dumps(payload, option=orjson.OPT_INDENT_2))
+    return path
+
+def _archive_batch(
+    save_pool: ThreadPoolExecutor,
+    chunk_raw: Dict[str, str],
+    email_by_id: Dict[str, Tuple[str, Email]],
+    archived_at: str,
+) -> List[Tuple[str, Path]]:
+    """Write one downloaded batch to disk; returns (id, path) for every file written."""
+    ids = list(chunk_raw)
+    paths: List[Path] = []
+    payloads: List[dict] = []
+    for mid in ids:
+        sender, email = email_by_id[mid]
+        paths.append(CONFIG.save_dir / f"{mid}_{sender.translate(_SAFE_TBL)[:48]}.json")
+        payloads.append({
+            **email,
+            "raw_b64": chunk_raw[mid],
+            "archived_at": archived_at,
+            "decision": "delete",
+            "sender_normalized": sender,
+        })
+    return list(zip(ids, save_pool.map(_write_archive, paths, payloads)))
 
 def execute_actions(state: AgentState) -> AgentState:
     saved = []
     trashed = []
+    ids_to_trash: List[str] = []
+    archived_at = datetime.now(timezone.utc).isoformat()   # one timestamp for the whole run
 
     st.subheader("Executing cleanup...")
 
-    for sender, decision in state["decisions"].items():
-        if decision != "delete":
-            continue
-
-        group = state["groups"].get(sender)
-        if not group:
-            continue
-
-        safe_sender = sender.replace("@", "_").replace(".", "_")[:48]
-
-        # Save phase
-        with st.status(f"Saving {group['count']} emails from {sender} ...", expanded=True):
-            for email in group["emails"]:
-                filename = f"{email['id']}_{safe_sender}.json"
-                path = CONFIG.save_dir / filename
-
-                payload = {
-                    **email,
-                    "archived_at": datetime.utcnow().isoformat(),
-                    "decision": "delete",
-                    "sender_normalized": sender,
-                }
-
-                with path.open("w", encoding="utf-8") as f:
-                    json.dump(payload, f, indent=2, ensure_ascii=False)
-
+    # Partition once; everything below only touches senders marked for deletion
+    delete_senders = [
+        sender for sender, decision in state["decisions"].items()
+        if decision == "delete" and sender in state["groups"]
+    ]
+
+    # Bodies never enter session state. Download them for the delete-set only, in
+    # small batches (raw includes attachments). See _fetch_all for the memory bound
+    email_by_id = {
+        email["id"]: (sender, email)
+        for sender in delete_senders
+        for email in state["groups"][sender]["emails"]
+    }
+
+    # Save phase — file writes overlap on one pool shared by the whole run
+    with ThreadPoolExecutor(max_workers=SAVE_WORKERS) as save_pool, st.status(
+        f"Saving {len(email_by_id)} emails from {len(delete_senders)} senders ...", expanded=True
+    ):
+        for chunk_raw, chunk_failed in _fetch_all(
+            list(email_by_id), _parse_raw, CONFIG.raw_batch_size, CONFIG.raw_workers, format="raw"
+        ):
+            for mid, err in chunk_failed.items():
+                st.error(f"Failed to download {mid}, keeping it in Gmail: {err}")
+
+            for mid, path in _archive_batch(save_pool, chunk_raw, email_by_id, archived_at):
                 saved.append(str(path))
-                st.write(f"Saved → {filename}")
-
-        # Trash phase
-        with st.status(f"Trashing {group['count']} messages from {sender} ...", expanded=True):
-            for email in group["emails"]:
-                try:
-                    SERVICE.users().messages().trash(userId="me", id=email["id"]).execute()
-                    trashed.append(email["id"])
-                    st.write(f"Trashed → {email['id'][:8]}…")
-                except HttpError as e:
-                    st.error(f"Failed to trash {email['id']}: {e}")
-
-    return {**state, "saved_paths": saved, "trashed_ids": trashed}
+                ids_to_trash.append(mid)
+                st.write(f"Saved → {path.name}")
+
+    # Trash phase — one batchModify call per TRASH_BATCH_SIZE ids
+    with st.status(f"Trashing {len(ids_to_trash)} messages ...", expanded=True):
+        for start in range(0, len(ids_to_trash), TRASH_BATCH_SIZE):
+            chunk = ids_to_trash[start:start + TRASH_BATCH_SIZE]
+            try:
+                SERVICE.users().messages().batchModify(
+                    userId="me",
+                    body={"ids": chunk, "addLabelIds": ["TRASH"], "removeLabelIds": ["INBOX"]},
+                ).execute()
+                trashed.extend(chunk)
+                st.write(f"Trashed → {len(chunk)} messages")
+            except HttpError as e:
+                st.error(f"Failed to trash {len(chunk)} messages ({chunk[0][:8]}… onwards): {e}")
+
+    return {"saved_paths": saved, "trashed_ids": trashed}
 
 # ──────────────────────────────────────────────────────────────
 # Streamlit UI
@@ -258,8 +436,9 @@ if st.session_state.stage == "welcome":
 
 # ─── Stage: Fetching & Grouping ──────────────────────────────────
 elif st.session_state.stage == "fetching":
-    st.session_state.state = fetch_emails(st.session_state.state)
-    st.session_state.state = group_by_sender(st.session_state.state)
+    # Nodes return only what they changed; merge it into the existing state dict
+    st.session_state.state.update(fetch_emails(st.session_state.state))
+    st.session_state.state.update(group_by_sender(st.session_state.state))
     st.session_state.stage = "review"
     st.rerun()
 
@@ -277,41 +456,49 @@ elif st.session_state.stage == "review":
 
     sorted_groups = sorted(groups.items(), key=lambda x: -x[1]["count"])
 
-    for sender, group in sorted_groups:
-        with st.expander(f"**{group['count']}** emails • {sender}", expanded=False):
-            st.markdown("**First few subjects:**")
-            for e in group["emails"][:3]:
-                subj = e["subject"][:90] + "…" if len(e["subject"]) > 90 else e["subject"]
-                st.write(f"• {subj}")
-
-            if group["count"] > 3:
-                st.caption(f"… +{group['count']-3} more")
-
-            col1, col2 = st.columns(2)
-            with col1:
-                if st.button("Keep (skip)", key=f"keep_{sender}", use_container_width=True):
-                    decisions[sender] = "skip"
-                    st.rerun()
-            with col2:
-                if st.button("Delete (save + trash)", key=f"del_{sender}", type="primary", use_container_width=True):
-                    decisions[sender] = "delete"
-                    st.rerun()
-
-            current = decisions.get(sender, "skip")
-            st.info(f"**Current choice:** {'Delete' if current == 'delete' else 'Keep'}", icon="ℹ️")
-
-    if st.button("Confirm choices & Run cleanup", type="primary", use_container_width=True):
-        if not any(d == "delete" for d in decisions.values()):
+    # One form for every sender: choices only submit (and rerun) once, on Confirm
+    with st.form("decisions_form"):
+        for sender, group in sorted_groups:
+            with st.expander(f"**{group['count']}** emails • {sender}", expanded=False):
+                st.markdown("**First few subjects:**")
+                for e in group["emails"][:3]:
+                    subj = e["subject"][:90] + "…" if len(e["subject"]) > 90 else e["subject"]
+                    st.write(f"• {subj}")
+                    if e["preview"]:
+                        st.caption(e["preview"])
+
+                if group["count"] > 3:
+                    st.caption(f"… +{group['count']-3} more")
+
+                st.radio(
+                    sender,
+                    ["skip", "delete"],
+                    index=1 if decisions.get(sender) == "delete" else 0,
+                    format_func=lambda d: "Delete (save + trash)" if d == "delete" else "Keep (skip)",
+                    key=f"dec_{sender}",
+                    horizontal=True,
+                    label_visibility="collapsed",
+                )
+
+        submitted = st.form_submit_button(
+            "Confirm choices & Run cleanup", type="primary", use_container_width=True
+        )
+
+    if submitted:
+        for sender in groups:
+            decisions[sender] = st.session_state[f"dec_{sender}"]
+        delete_senders = [s for s in groups if decisions[s] == "delete"]
+
+        if not delete_senders:
             st.warning("No senders selected for deletion.")
         else:
-            total_delete = sum(g["count"] for s, g in groups.items() if decisions.get(s) == "delete")
             st.session_state.state["decisions"] = decisions.copy()
             st.session_state.stage = "executing"
             st.rerun()
 
 # ─── Stage: Executing ────────────────────────────────────────────
 elif st.session_state.stage == "executing":
-    st.session_state.state = execute_actions(st.session_state.state)
+    st.session_state.state.update(execute_actions(st.session_state.state))
     st.session_state.stage = "finished"
     st.rerun()
 
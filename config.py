@@ -20,6 +20,20 @@ class GmailConfig(BaseSettings):
     save_dir: Path = Path("saved_emails")
     max_fetch: int = Field(default=10, ge=10, le=500)
 
+    # Fetching — Gmail accepts up to 100 calls per batch, but batches larger than 50
+    # are likely to be rate-limited. fetch_batch_size × fetch_workers calls are in
+    # flight at once: the defaults send 200 messages.get (1000 quota units), above
+    # the ~250 units/sec sustained quota. That relies on Gmail's burst tolerance, and
+    # on the 429 backoff in _fetch_chunk when it runs out; lower fetch_workers to
+    # stay within the sustained rate at the cost of a slower fetch.
+    fetch_batch_size: int = Field(default=50, ge=1, le=50)
+    fetch_workers: int = Field(default=4, ge=1, le=10)
+
+    # Archive downloads (format=raw) are whole messages, attachments included, so they
+    # use smaller batches: at most raw_batch_size × (raw_workers + 1) are in memory at once
+    raw_batch_size: int = Field(default=10, ge=1, le=50)
+    raw_workers: int = Field(default=2, ge=1, le=10)
+
     # Thread naming / identification
     thread_prefix: str = "gmail-clean-"
 
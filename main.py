@@ -1,17 +1,27 @@
 
 
 import os
-import json
-import base64
-from typing import TypedDict, List, Dict, Literal, Annotated
-from datetime import datetime
+import html
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import islice
+from typing import TypedDict, List, Dict, Literal, Annotated, Tuple, Any, Callable, Iterator, DefaultDict
+from datetime import datetime, timezone
 from pathlib import Path
 
+import orjson
+
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
+from googleapiclient.http import build_http, set_user_agent
 
 from langgraph.graph import StateGraph, END
 from langgraph.checkpoint.memory import MemorySaver
@@ -25,7 +35,6 @@ class Email(TypedDict):
     subject: str
     sender: str
     date: str
-    body_b64: str
     preview: str
 
 
@@ -48,7 +57,7 @@ class AgentState(TypedDict):
     run_started: str
 
 
-def get_gmail_service(config=CONFIG):
+def get_gmail_credentials(config=CONFIG) -> Credentials:
     creds = None
     if config.token_file.exists():
         creds = Credentials.from_authorized_user_file(str(config.token_file), config.scopes)
@@ -66,10 +75,147 @@ def get_gmail_service(config=CONFIG):
         with config.token_file.open("w") as f:
             f.write(creds.to_json())
 
-    return build("gmail", "v1", credentials=creds)
+    return creds
+
+
+# Google only gzips responses when the User-Agent mentions gzip; googleapiclient
+# does this for single calls but not for the multipart batch envelope
+USER_AGENT = "gmail-agent (gzip)"
+
+
+def _authorized_http(creds: Credentials) -> AuthorizedHttp:
+    # build_http() is what build(credentials=...) uses: it sets the socket timeout
+    # and redirect handling. The User-Agent goes on this inner transport because
+    # AuthorizedHttp.request re-enters itself with extra kwargs on a 401 retry.
+    return AuthorizedHttp(creds, http=set_user_agent(build_http(), USER_AGENT))
+
+
+def get_gmail_service(creds: Credentials):
+    # The Gmail discovery document ships with googleapiclient — no HTTP fetch needed
+    return build(
+        "gmail", "v1",
+        http=_authorized_http(creds),
+        static_discovery=True,
+        cache_discovery=False,
+    )
+
+
+CREDS = get_gmail_credentials()
+SERVICE = get_gmail_service(CREDS)
+
+TRASH_BATCH_SIZE = 1000  # messages.batchModify accepts at most 1000 ids
+SAVE_WORKERS = 16        # concurrent archive file writes
+MAX_RETRIES = 5
+RETRY_STATUSES = {429, 503}
+METADATA_HEADERS = ["Subject", "From", "Date"]
+WANTED_HEADERS = frozenset(h.lower() for h in METADATA_HEADERS)
+SENDER_RE = re.compile(r"<([^>]+)>")   # address part of "Name <addr@host>"
+_SAFE_TBL = str.maketrans({"@": "_", ".": "_", "/": "_", "\\": "_"})   # sender → filename-safe
+
+# httplib2 connections are not thread-safe, so every worker thread gets its own
+_thread_local = threading.local()
+
+
+def _thread_http() -> AuthorizedHttp:
+    if not hasattr(_thread_local, "http"):
+        _thread_local.http = _authorized_http(CREDS)
+    return _thread_local.http
+
+
+def _is_retryable(error: Exception) -> bool:
+    return isinstance(error, HttpError) and error.resp.status in RETRY_STATUSES
+
+
+def _parse_metadata(mid: str, msg: dict) -> Email:
+    headers: Dict[str, str] = {}
+    for h in msg["payload"]["headers"]:
+        name = h["name"].lower()
+        if name in WANTED_HEADERS and name not in headers:
+            headers[name] = h["value"]
+            if len(headers) == len(WANTED_HEADERS):
+                break
+
+    snippet = html.unescape(msg.get("snippet", ""))   # Gmail entity-escapes snippets
+
+    return {
+        "id": mid,
+        "subject": headers.get("subject", "(no subject)"),
+        "sender": headers.get("from", "Unknown"),
+        "date": headers.get("date", "Unknown"),
+        "preview": snippet[:140] + "…" if len(snippet) > 140 else snippet,
+    }
+
 
+def _parse_raw(mid: str, msg: dict) -> str:
+    return msg["raw"]
 
-SERVICE = get_gmail_service()
+
+def _fetch_chunk(ids: List[str], parse: Callable, **params) -> Tuple[Dict[str, Any], Dict[str, Exception]]:
+    """Fetch one batch of messages, retrying rate-limited calls with exponential backoff."""
+    fetched: Dict[str, Any] = {}
+    failed: Dict[str, Exception] = {}
+    pending = ids
+
+    for attempt in range(MAX_RETRIES + 1):
+        retry: Dict[str, Exception] = {}
+
+        def on_message(request_id, msg, exception):
+            if exception is None:
+                fetched[request_id] = parse(request_id, msg)
+            elif _is_retryable(exception):
+                retry[request_id] = exception
+            else:
+                failed[request_id] = exception
+
+        batch = SERVICE.new_batch_http_request(callback=on_message)
+        for mid in pending:
+            batch.add(
+                SERVICE.users().messages().get(userId="me", id=mid, **params),
+                request_id=mid,
+            )
+
+        try:
+            batch.execute(http=_thread_http())
+        except HttpError as e:
+            if not _is_retryable(e):
+                failed.update(dict.fromkeys(pending, e))
+                break
+            retry = dict.fromkeys(pending, e)
+
+        if not retry:
+            break
+        if attempt == MAX_RETRIES:
+            failed.update(retry)
+            break
+
+        time.sleep(2 ** attempt + random.random())
+        pending = list(retry)
+
+    return fetched, failed
+
+
+def _fetch_all(
+    ids: List[str], parse: Callable, batch_size: int, workers: int, **params
+) -> Iterator[Tuple[Dict[str, Any], Dict[str, Exception]]]:
+    """Fetch ids in batches on the worker pool, yielding each batch's results as it completes.
+
+    Only `workers` batches are queued at a time, and a new one is queued only after a
+    finished batch has been handed to the caller. So at most workers + 1 batches are
+    held at once: the ones downloading and the one the caller is still processing.
+    """
+    chunks = (ids[start:start + batch_size] for start in range(0, len(ids), batch_size))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {pool.submit(_fetch_chunk, chunk, parse, **params) for chunk in islice(chunks, workers)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            while done:
+                result = done.pop().result()
+                yield result
+                del result  # release this batch before queueing the next one
+
+                chunk = next(chunks, None)
+                if chunk is not None:
+                    pending.add(pool.submit(_fetch_chunk, chunk, parse, **params))
 
 
 def fetch_emails(state: AgentState) -> AgentState:
@@ -82,42 +228,27 @@ def fetch_emails(state: AgentState) -> AgentState:
         ).execute()
 
         ids = [m["id"] for m in res.get("messages", [])]
-        emails: List[Email] = []
-
-        for i, mid in enumerate(ids, 1):
-            print(f"  {i}/{len(ids)}", end="\r")
-            msg = SERVICE.users().messages().get(
-                userId="me", id=mid, format="full"
-            ).execute()
-
-            headers = {h["name"].lower(): h["value"] for h in msg["payload"]["headers"]}
-
-            body_b64 = ""
-            payload = msg["payload"]
-            if "parts" in payload:
-                for part in payload["parts"]:
-                    if part.get("mimeType") == "text/plain" and "data" in part.get("body", {}):
-                        body_b64 = part["body"]["data"]
-                        break
-            elif "body" in payload and "data" in payload["body"]:
-                body_b64 = payload["body"]["data"]
-
-            preview = ""
-            if body_b64:
-                try:
-                    decoded = base64.urlsafe_b64decode(body_b64).decode("utf-8", errors="replace")
-                    preview = decoded[:140] + "…" if len(decoded) > 140 else decoded
-                except Exception:
-                    preview = "[decode error]"
-
-            emails.append({
-                "id": mid,
-                "subject": headers.get("subject", "(no subject)"),
-                "sender": headers.get("from", "Unknown"),
-                "date": headers.get("date", "Unknown"),
-                "body_b64": body_b64,
-                "preview": preview,
-            })
+        fetched: Dict[str, Email] = {}
+        done = 0
+
+        # One HTTP round-trip per batch, several batches in flight at once
+        for chunk_emails, chunk_failed in _fetch_all(
+            ids,
+            _parse_metadata,
+            CONFIG.fetch_batch_size,
+            CONFIG.fetch_workers,
+            format="metadata",
+            metadataHeaders=METADATA_HEADERS,
+        ):
+            fetched.update(chunk_emails)
+            for mid, err in chunk_failed.items():
+                print(f"\n  failed to fetch {mid}: {err}")
+
+            done += len(chunk_emails) + len(chunk_failed)
+            print(f"  {done}/{len(ids)}", end="\r")
+
+        # Keep the inbox order regardless of which chunk finished first
+        emails: List[Email] = [fetched[mid] for mid in ids if mid in fetched]
 
         print(f"\n→ Fetched {len(emails)} emails")
         return {"emails": emails}
@@ -128,19 +259,17 @@ def fetch_emails(state: AgentState) -> AgentState:
 
 
 def group_by_sender(state: AgentState) -> AgentState:
-    groups: Dict[str, SenderGroup] = {}
+    by_sender: DefaultDict[str, List[Email]] = defaultdict(list)
 
     for email in state.get("emails", []):
-        sender_raw = email["sender"].strip()
-        sender = (
-            sender_raw.split("<")[1].split(">")[0].strip().lower()
-            if "<" in sender_raw and ">" in sender_raw else sender_raw.lower()
-        )
+        m = SENDER_RE.search(email["sender"])
+        sender = (m.group(1) if m else email["sender"]).strip().lower()
+        by_sender[sender].append(email)
 
-        if sender not in groups:
-            groups[sender] = {"sender": sender, "emails": [], "count": 0}
-        groups[sender]["emails"].append(email)
-        groups[sender]["count"] += 1
+    groups: Dict[str, SenderGroup] = {
+        sender: {"sender": sender, "emails": emails, "count": len(emails)}
+        for sender, emails in by_sender.items()
+    }
 
     print(f"→ Grouped into {len(groups)} senders")
     return {"groups": groups}
@@ -185,51 +314,84 @@ def human_review(state: AgentState) -> AgentState:
     return {"decisions": decisions}
 
 
+def _write_archive(path: Path, payload: dict) -> Path:
+    # orjson emits UTF-8 bytes directly, like json.dump(..., ensure_ascii=False)
+    path.write_bytes(orjson.dumps(payload, option=orjson.OPT_INDENT_2))
+    return path
+
+
+def _archive_batch(
+    save_pool: ThreadPoolExecutor,
+    chunk_raw: Dict[str, str],
+    email_by_id: Dict[str, Tuple[str, Email]],
+    archived_at: str,
+) -> List[Tuple[str, Path]]:
+    """Write one downloaded batch to disk; returns (id, path) for every file written."""
+    ids = list(chunk_raw)
+    paths: List[Path] = []
+    payloads: List[dict] = []
+    for mid in ids:
+        sender, email = email_by_id[mid]
+        paths.append(CONFIG.save_dir / f"{mid}_{sender.translate(_SAFE_TBL)[:48]}.json")
+        payloads.append({
+            **email,
+            "raw_b64": chunk_raw[mid],
+            "archived_at": archived_at,
+            "decision": "delete",
+            "sender_normalized": sender,
+        })
+    return list(zip(ids, save_pool.map(_write_archive, paths, payloads)))
+
+
 def execute_actions(state: AgentState) -> AgentState:
     saved = []
     trashed = []
+    ids_to_trash: List[str] = []
+    archived_at = datetime.now(timezone.utc).isoformat()   # one timestamp for the whole run
 
     print("\nExecuting decisions...\n")
 
-    # Process only senders marked for deletion
-    for sender, decision in state["decisions"].items():
-        if decision != "delete":
-            continue
-
-        group = state["groups"].get(sender)
-        if not group:
-            continue
-
-        safe_sender = sender.replace("@", "_").replace(".", "_")[:48]
-
-        # Phase 1: SAVE LOCALLY (always first!)
-        print(f"  Saving {group['count']} emails from {sender} ...")
-        for email in group["emails"]:
-            filename = f"{email['id']}_{safe_sender}.json"
-            path = CONFIG.save_dir / filename
-
-            payload = {
-                **email,
-                "archived_at": datetime.utcnow().isoformat(),
-                "decision": "delete",
-                "sender_normalized": sender,
-            }
-
-            with path.open("w", encoding="utf-8") as f:
-                json.dump(payload, f, indent=2, ensure_ascii=False)
-
-            saved.append(str(path))
-            print(f"     saved → {filename}")
-
-        # Phase 2: TRASH from Gmail
-        print(f"  Trashing {group['count']} messages from {sender} ...")
-        for email in group["emails"]:
-            try:
-                SERVICE.users().messages().trash(userId="me", id=email["id"]).execute()
-                trashed.append(email["id"])
-                print(f"     trashed → {email['id'][:8]}…")
-            except HttpError as e:
-                print(f"     failed to trash {email['id']}: {e}")
+    # Partition once; everything below only touches senders marked for deletion
+    delete_senders = [
+        sender for sender, decision in state["decisions"].items()
+        if decision == "delete" and sender in state["groups"]
+    ]
+
+    # Bodies never enter the graph state. Download them for the delete-set only, in
+    # small batches (raw includes attachments). See _fetch_all for the memory bound
+    email_by_id = {
+        email["id"]: (sender, email)
+        for sender in delete_senders
+        for email in state["groups"][sender]["emails"]
+    }
+
+    # Phase 1: SAVE LOCALLY (always first!) — writes overlap on one pool for the whole run
+    print(f"  Saving {len(email_by_id)} emails from {len(delete_senders)} senders ...")
+    with ThreadPoolExecutor(max_workers=SAVE_WORKERS) as save_pool:
+        for chunk_raw, chunk_failed in _fetch_all(
+            list(email_by_id), _parse_raw, CONFIG.raw_batch_size, CONFIG.raw_workers, format="raw"
+        ):
+            for mid, err in chunk_failed.items():
+                print(f"     failed to download {mid}, keeping it in Gmail: {err}")
+
+            for mid, path in _archive_batch(save_pool, chunk_raw, email_by_id, archived_at):
+                saved.append(str(path))
+                ids_to_trash.append(mid)
+                print(f"     saved → {path.name}")
+
+    # Phase 2: TRASH from Gmail — one batchModify call per TRASH_BATCH_SIZE ids
+    print(f"  Trashing {len(ids_to_trash)} messages ...")
+    for start in range(0, len(ids_to_trash), TRASH_BATCH_SIZE):
+        chunk = ids_to_trash[start:start + TRASH_BATCH_SIZE]
+        try:
+            SERVICE.users().messages().batchModify(
+                userId="me",
+                body={"ids": chunk, "addLabelIds": ["TRASH"], "removeLabelIds": ["INBOX"]},
+            ).execute()
+            trashed.extend(chunk)
+            print(f"     trashed → {len(chunk)} messages")
+        except HttpError as e:
+            print(f"     failed to trash {len(chunk)} messages ({chunk[0][:8]}… onwards): {e}")
 
     return {
         "saved_paths": saved,